@@ -2,112 +2,369 @@
 """
 
 from dataclasses import dataclass
+import functools
+import html
+import http.client
 import http.server
-import traceback
+import io
+import logging
+import os
+import signal
+import time
 import typing
 
 
+_logger = logging.getLogger(__name__)
+
+
 def serve(binding, generic_handler=None,
           GET=None, HEAD=None, POST=None, PUT=None, DELETE=None, CONNECT=None,
-          OPTIONS=None, TRACE=None, PATCH=None):
+          OPTIONS=None, TRACE=None, PATCH=None, workers=1):
     """Serve HTTP requests from the specified `binding` (address, port).
     Use the optionally specified `generic_handler` to process `Request`s.
     Use the optionally specified command-specific handlers to process
-    requests of the relevant command (e.g. GET, POST).  Return when SIGTERM
-    is sent to the thread invoking this function.
+    requests of the relevant command (e.g. GET, POST).  Each connection is
+    handled on its own thread, so handlers may be called concurrently.  If
+    `workers` is greater than one, fork that many processes to serve
+    requests from the same socket (this requires `os.fork`).  Return when
+    SIGTERM is sent to the thread invoking this function.
     """
 
-    class RequestHandler(_RequestHandler):
-        def do_GET(self):
-            return self.handle_command('GET', GET or generic_handler)
-        def do_HEAD(self):
-            return self.handle_command('HEAD', HEAD or generic_handler)
-        def do_POST(self):
-            return self.handle_command('POST', POST or generic_handler)
-        def do_PUT(self):
-            return self.handle_command('PUT', PUT or generic_handler)
-        def do_DELETE(self):
-            return self.handle_command('DELETE', DELETE or generic_handler)
-        def do_CONNECT(self):
-            return self.handle_command('CONNECT', CONNECT or generic_handler)
-        def do_OPTIONS(self):
-            return self.handle_command('OPTIONS', OPTIONS or generic_handler)
-        def do_TRACE(self):
-            return self.handle_command('TRACE', TRACE or generic_handler)
-
-    server = http.server.HTTPServer(binding, RequestHandler)
+    server = http.server.ThreadingHTTPServer(binding, _RequestHandler)
+    # Resolve each command's handler once, rather than on every request.
+    server.handlers = {
+        'GET': GET or generic_handler,
+        'HEAD': HEAD or generic_handler,
+        'POST': POST or generic_handler,
+        'PUT': PUT or generic_handler,
+        'DELETE': DELETE or generic_handler,
+        'CONNECT': CONNECT or generic_handler,
+        'OPTIONS': OPTIONS or generic_handler,
+        'TRACE': TRACE or generic_handler,
+        'PATCH': PATCH or generic_handler
+    }
 
     try:
-        server.serve_forever()
+        if workers > 1:
+            _serve_in_workers(server, workers)
+        else:
+            server.serve_forever()
     except KeyboardInterrupt:
         pass  # SIGTERM: time to clean up
     finally:
         server.server_close()
 
 
-@dataclass
+def _serve_in_workers(server, workers):
+    """Fork `workers` child processes, each of which serves requests from
+    the listening socket of the specified `server`, and replace any that
+    exit until interrupted.  Then terminate the children and wait for them.
+    """
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+
+    # Children inherit this, so SIGTERM stops parent and children alike.
+    previous_handler = signal.signal(signal.SIGTERM, interrupt)
+    children = {}  # pid: start time
+    try:
+        for _ in range(workers):
+            _fork_worker(server, children)
+
+        while True:
+            pid, status = os.wait()
+            started = children.pop(pid, None)
+            if started is None:
+                continue  # not one of ours
+            _logger.error('worker process %d exited with %s; replacing it',
+                          pid, _describe_exit(status))
+            # Don't spin if workers die as soon as they start.
+            if time.monotonic() - started < _MIN_WORKER_LIFETIME:
+                time.sleep(_MIN_WORKER_LIFETIME)
+            _fork_worker(server, children)
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        for pid in children:
+            os.waitpid(pid, 0)
+        signal.signal(signal.SIGTERM, previous_handler)
+
+
+_MIN_WORKER_LIFETIME = 1  # seconds
+
+
+def _fork_worker(server, children):
+    """Fork a child process that serves requests from the specified
+    `server`, and record it in `children`.  Interruptions are held off
+    until the child is recorded, so that it is always terminated later.
+    """
+    interruptions = {signal.SIGINT, signal.SIGTERM}
+    previous_mask = signal.pthread_sigmask(signal.SIG_BLOCK, interruptions)
+    try:
+        pid = os.fork()
+        if pid == 0:
+            signal.pthread_sigmask(signal.SIG_SETMASK, previous_mask)
+            _serve_in_child(server)
+        children[pid] = time.monotonic()
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, previous_mask)
+
+
+def _describe_exit(status):
+    if os.WIFSIGNALED(status):
+        return f'signal {os.WTERMSIG(status)}'
+    return f'status {os.WEXITSTATUS(status)}'
+
+
+def _serve_in_child(server):
+    """Serve requests from the specified `server` and then exit the process
+    without returning, so that the child never runs its parent's cleanup.
+    """
+    status = 0
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass  # SIGTERM: time to clean up
+    except BaseException:
+        _logger.exception('worker process %d failed', os.getpid())
+        status = 1
+    finally:
+        os._exit(status)
+
+
+@dataclass(init=False)
 class Request:
-    """A `Request` is what is passed to the handler(s) in `serve`."""
+    """A `Request` is what is passed to the handler(s) in `serve`.
+    `headers` is the `http.client.HTTPMessage` parsed from the request, not
+    a `dict`: lookups ignore case, `headers[name]` is `None` for a missing
+    header rather than raising `KeyError`, `dict` methods like `copy` are
+    absent, and it is not a copy, so modifying it modifies the headers that
+    `http.server` parsed.  Use `dict(request.headers)` where a plain `dict`
+    is needed (e.g. for `json.dumps`).
+    """
+
+    # One `Request` is made per request, so skip the per-instance `__dict__`.
+    # A class attribute default would clash with its slot, so `body`'s
+    # default is given in `__init__` instead.
+    __slots__ = ('client', 'command', 'path', 'headers', 'body')
 
     client: typing.Tuple[str, int]  # (host, port)
     command: str
     path: str
-    headers: dict
-    body: typing.Optional[bytes] = None
+    headers: http.client.HTTPMessage  # case-insensitive, `None` if missing
+    body: typing.Optional[bytes]
+
+    def __init__(self, client, command, path, headers, body=None):
+        self.client = client
+        self.command = command
+        self.path = path
+        self.headers = headers
+        self.body = body
 
 
 @dataclass
 class Response:
-    """A `Response` is what is returned by the handler(s) in `serve`."""
+    """A `Response` is what is returned by the handler(s) in `serve`.
+    `body` is either `bytes` or a seekable binary file object, such as one
+    returned by `open(path, 'rb')` or an `io.BytesIO`.  A file is sent from
+    its current position to its end, and then closed.
+    """
 
     status: typing.Optional[int] = 200
     content_type: typing.Optional[str] = 'text/html'
-    body: typing.Optional[bytes] = None
+    body: typing.Union[bytes, typing.BinaryIO, None] = None
+
+
+_INTERNAL_SERVER_ERROR = 500
+_NOT_IMPLEMENTED = 501
+
+
+def _is_error(status):
+    return 400 <= status <= 599
 
 
 class _RequestHandler(http.server.BaseHTTPRequestHandler):
-    def handle_command(self, command, handler):
+    """Handle a request by calling the handler registered for its command
+    in `self.server.handlers`, which `serve` sets up.
+    """
+
+    def do_GET(self):
+        return self.handle_command('GET')
+    def do_HEAD(self):
+        return self.handle_command('HEAD')
+    def do_POST(self):
+        return self.handle_command('POST')
+    def do_PUT(self):
+        return self.handle_command('PUT')
+    def do_DELETE(self):
+        return self.handle_command('DELETE')
+    def do_CONNECT(self):
+        return self.handle_command('CONNECT')
+    def do_OPTIONS(self):
+        return self.handle_command('OPTIONS')
+    def do_TRACE(self):
+        return self.handle_command('TRACE')
+    def do_PATCH(self):
+        return self.handle_command('PATCH')
+
+    def handle_command(self, command):
+        handler = self.server.handlers[command]
         try:
             return self._do_handle_command(command, handler)
         except Exception:
-            traceback.print_exc()
-            INTERNAL_SERVER_ERROR = 500
-            self.send_error(INTERNAL_SERVER_ERROR)
+            _logger.exception('error handling %s %s', command, self.path)
+            self._send_error(_INTERNAL_SERVER_ERROR)
 
     def _do_handle_command(self, command, handler):
-        NOT_IMPLEMENTED = 501
-
-        def is_error(status):
-            return 400 <= status <= 599
-
         if handler is None:
-            self.send_error(
-                NOT_IMPLEMENTED,
-                explain=f'{command} is not implemented for this service.')
+            self._send_error(
+                _NOT_IMPLEMENTED,
+                f'{command} is not implemented for this service.')
             return
         
         request = Request(self.client_address,
                           command,
                           self.path,
-                          dict(self.headers),
+                          self.headers,
                           None)
 
         body_length = self.headers.get('Content-Length')
-        if body_length is not None:
-            body_length = int(body_length)
-            request.body = self.rfile.read(body_length)
+        if body_length:
+            request.body = self.rfile.read(int(body_length))
 
         response = handler(request)
 
-        if is_error(response.status):
-            self.send_error(response.status)
+        if _is_error(response.status) and response.body is None:
+            self._send_error(response.status)
+            return
+
+        # Anything with `read` is a file.  Rule out the usual bodies, `None`
+        # and `bytes`, first, since a failed `hasattr` is comparatively slow.
+        if (response.body is not None and
+                type(response.body) is not bytes and
+                hasattr(response.body, 'read')):
+            self._send_file(response.status,
+                            response.content_type,
+                            response.body)
         else:
-            self.send_response(response.status)
+            self._send_bytes(response.status,
+                             response.content_type,
+                             response.body)
+
+    def _send_bytes(self, status, content_type, body):
+        """Send a reply whose `body` is `bytes` or `None`.  Write the status
+        line, the headers, and the body at once, unless the body is large
+        enough that copying it would cost more than a second write.  Leave
+        out the body, but not its headers, when replying to HEAD.
+        """
+        self.log_request(status)
+        if body is None:
+            self.wfile.write(self._head(status))
+            return
 
-        if response.body is not None:
-            self.send_header('Content-Type', response.content_type)
-            self.send_header('Content-Length', len(response.body))
-            self.end_headers()
-            self.wfile.write(response.body)
+        head = self._head(status, _content_headers(content_type, len(body)))
+        if self.command == 'HEAD':
+            self.wfile.write(head)
+        elif len(body) < _MAX_COPIED_BODY:
+            self.wfile.write(head + body)
         else:
-            self.end_headers()
+            self.wfile.write(head)
+            self.wfile.write(body)
+
+    def _send_file(self, status, content_type, file):
+        """Send a reply whose body is the rest of `file`, and close `file`.
+        Check that `file` can be sent before writing anything, so that a
+        file that can't be sent results in a 500 rather than a broken reply.
+        """
+        with file:
+            if 'b' not in getattr(file, 'mode', 'b'):
+                raise ValueError(f'file body {file!r} is not in binary mode')
+            position = file.tell()
+            length = file.seek(0, io.SEEK_END) - position
+            file.seek(position)
+
+            self.log_request(status)
+            self.wfile.write(
+                self._head(status, _content_headers(content_type, length)))
+            if self.command != 'HEAD':
+                # `sendfile(2)` where available: the kernel copies straight
+                # from the file to the socket.  Otherwise, `socket.sendfile`
+                # falls back to `send`.
+                self.connection.sendfile(file, position, length)
+
+    def _send_error(self, code, explain=None):
+        """Send the same reply as `send_error`, but from precomputed bytes
+        and without logging an error, since `log_request` already logs the
+        status code.
+        """
+        self.log_request(code)
+        message, headers, body = _error_response(code, explain)
+        if self.command == 'HEAD':
+            body = b''
+        self.wfile.write(self._head(code, headers, message) + body)
+        self.close_connection = True
+
+    def _head(self, status, headers=b'', message=None):
+        """Return what `send_response`, any `send_header`, and `end_headers`
+        would write for a reply with the specified `status`, as one `bytes`.
+        `headers` are any header lines to follow Server and Date.
+        """
+        if self.request_version == 'HTTP/0.9':
+            return b''
+
+        date = self.date_time_string().encode('latin-1')
+        return b''.join((_status_and_server(status, message),
+                         b'Date: ', date, b'\r\n',
+                         headers,
+                         b'\r\n'))
+
+
+# Bodies shorter than this are copied into the same buffer as the headers.
+_MAX_COPIED_BODY = 64 * 1024
+
+
+def _content_headers(content_type, length):
+    return (_content_type_header(content_type) +
+            b'Content-Length: %d\r\n' % length)
+
+
+@functools.lru_cache(maxsize=128)
+def _content_type_header(content_type):
+    return f'Content-Type: {content_type}\r\n'.encode('latin-1')
+
+
+@functools.lru_cache(maxsize=None)
+def _status_and_server(status, message=None):
+    """Return the status line and Server header of a reply with the
+    specified `status`.  These are the same for every such reply.
+    """
+    handler = _RequestHandler
+    if message is None:
+        message = handler.responses.get(status, ('',))[0]
+
+    return (f'{handler.protocol_version} {status} {message}\r\n'
+            f'Server: {handler.server_version} {handler.sys_version}\r\n'
+            ).encode('latin-1')
+
+
+@functools.lru_cache(maxsize=None)
+def _error_response(code, explain=None):
+    """Return `(message, headers, body)`, the parts of an error reply with
+    the specified status `code` that don't change from one request to the
+    next.  `headers` are the header lines that follow Server and Date.
+    """
+    handler = _RequestHandler
+    message, long_message = handler.responses.get(code, ('???', '???'))
+    if explain is None:
+        explain = long_message
+
+    body = (handler.error_message_format % {
+        'code': code,
+        'message': html.escape(message, quote=False),
+        'explain': html.escape(explain, quote=False)
+    }).encode('UTF-8', 'replace')
+
+    headers = ('Connection: close\r\n'
+               f'Content-Type: {handler.error_content_type}\r\n'
+               f'Content-Length: {len(body)}\r\n')
+
+    return message, headers.encode('latin-1'), body